@@ -1,11 +1,19 @@
 import os
 import sys
 import json
+import html
+import time
+import sqlite3
+import asyncio
+import aiohttp
+import orjson
 import requests
+from urllib3.util.retry import Retry
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+import zipfile
+from functools import lru_cache
 from tqdm import tqdm
-from ebooklib import epub
 from typing import Dict, List, Optional
 
 CONFIG_PATH = "config.json"
@@ -18,8 +26,32 @@ DEFAULT_CONFIG = {
 }
 
 DISCLAIMER = "本工具仅供学习交流"
+BATCH_SIZE = 20
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
 os.makedirs('download', exist_ok=True)
 
+# 磁盘缓存：重复下载同一本书时跳过已完成的请求
+CACHE_DIR = os.path.join('download', '.cache')
+METADATA_CACHE_TTL = 86400
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+def _open_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(CACHE_DIR, 'cache.db'))
+    conn.execute("CREATE TABLE IF NOT EXISTS chapters (item_id TEXT PRIMARY KEY, content TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (book_id TEXT PRIMARY KEY, info TEXT, fetched_at REAL)")
+    conn.commit()
+    return conn
+
+cache = _open_cache()
+
 # 加载配置
 def load_config() -> Dict:
     if os.path.exists(CONFIG_PATH):
@@ -45,23 +77,36 @@ class Colors:
 
 # 全局会话
 session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=64, pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "POST"])))
 session.headers.update({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
 })
 
-book_info_cache = {}
+_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+_BOOK_ID_RE = re.compile(r'(\d{10,20})')
+_CLEAN_RE = re.compile(r'</p\u003e|<p\u003e|<p idx="\d+"\u003e')
 
+def _clean_repl(m: re.Match) -> str:
+    tag = m.group(0)
+    return '\n' if tag in ('</p>', '<p>') else ''
+
+@lru_cache(maxsize=1024)
 def sanitize_filename(name: str) -> str:
-    return re.sub(r'[\\/*?:"<>|]', '', name).strip()[:100]
+    return _SANITIZE_RE.sub('', name).strip()[:100]
 
+@lru_cache(maxsize=1024)
 def extract_book_id_from_url(url: str) -> Optional[str]:
     url = url.strip()
-    m = re.search(r'(\d{10,20})', url)
+    m = _BOOK_ID_RE.search(url)
     return m.group(1) if m else None
 
+@lru_cache(maxsize=256)
 def get_book_metadata(book_id: str) -> Dict:
-    if book_id in book_info_cache:
-        return book_info_cache[book_id]
+    row = cache.execute("SELECT info, fetched_at FROM metadata WHERE book_id=?", (book_id,)).fetchone()
+    if row and time.time() - row[1] < METADATA_CACHE_TTL:
+        return json.loads(row[0])
 
     metadata = {
         "book_name": f"未知书名_{book_id}",
@@ -84,7 +129,7 @@ def get_book_metadata(book_id: str) -> Dict:
         }
         resp = session.get(api_url, params=params, timeout=config["api_timeout"])
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
 
         if data.get("code") == 0 and data.get("data"):
             book_data = data["data"][0]
@@ -108,14 +153,15 @@ def get_book_metadata(book_id: str) -> Dict:
         print(f"{Colors.wrap('获取Text信息失败', Colors.RED)}: {str(e)}")
         sys.exit(1)
 
-    book_info_cache[book_id] = metadata
+    cache.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)", (book_id, json.dumps(metadata, ensure_ascii=False), time.time()))
+    cache.commit()
     return metadata
 
 def get_chapter_list(book_id: str) -> List[Dict]:
     url = f"https://toma.jam.cz.eu.org.cdn.cloudflare.net/directory?bookId={book_id}"
     try:
         resp = session.get(url, timeout=config["api_timeout"])
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if data.get("code") == 0:
             chapters = []
             for volume in data["data"]["chapterListWithVolume"]:
@@ -126,92 +172,174 @@ def get_chapter_list(book_id: str) -> List[Dict]:
         print(f"{Colors.wrap('获取章节列表失败', Colors.RED)}: {str(e)}")
     sys.exit(1)
 
-def download_chapter(item_id: str) -> Optional[str]:
+def _store_chapter(item_id: str, content: str) -> str:
+    clean = html.unescape(_CLEAN_RE.sub(_clean_repl, content)).strip()
+    cache.execute("INSERT OR REPLACE INTO chapters VALUES (?, ?)", (item_id, clean))
+    cache.commit()
+    return clean
+
+async def _post_json(session: aiohttp.ClientSession, url: str, params: Dict, timeout: aiohttp.ClientTimeout) -> Dict:
+    # 429/5xx 指数退避重试；其余错误直接抛给调用方
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with session.post(url, params=params, timeout=timeout) as resp:
+                if resp.status in RETRY_STATUSES:
+                    resp.raise_for_status()
+                return orjson.loads(await resp.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+async def download_chapter(session: aiohttp.ClientSession, item_id: str) -> Optional[str]:
+    row = cache.execute("SELECT content FROM chapters WHERE item_id=?", (item_id,)).fetchone()
+    if row:
+        return row[0]
+
     url = "https://toma.jam.cz.eu.org.cdn.cloudflare.net/down/"
     params = {"item_id": item_id, "novelsdk_aid": "638505", "sdk_type": "4"}
     try:
-        resp = session.post(url, params=params, timeout=(5, 15))
-        data = resp.json()
-        if data.get("code") == 0 and "content" in data.get("data", {}):
-            content = data["data"]["content"]
-            clean_content = content.replace('<p>', '\n').replace('</p>', '\n').replace('&quot;', '"').replace('&amp;', '&')
-            return re.sub(r'<p idx="\d+"\u003e', '', clean_content).strip()
-    except:
+        data = await _post_json(session, url, params, aiohttp.ClientTimeout(total=15))
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+        return None
+    if data.get("code") == 0 and "content" in data.get("data", {}):
+        return _store_chapter(item_id, data["data"]["content"])
+    return None
+
+async def _fetch_cover(session: aiohttp.ClientSession, cover_url: str) -> Optional[bytes]:
+    try:
+        async with session.get(cover_url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            if resp.status == 200:
+                return await resp.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
         pass
     return None
 
-def build_txt(metadata: Dict, chapters: List[Dict], output_path: str):
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write("第0章：声明\n\n" + DISCLAIMER + "\n\n" + "-"*50 + "\n\n")
-        f.write(f"《{metadata['book_name']}》\n作者：{metadata['author']}\n类型：{metadata['category']} | 状态：{metadata['status']}\n\n简介：{metadata['summary']}\n\n" + "="*50 + "\n\n")
-        for i, chap in enumerate(chapters):
-            f.write(f"第{i+1}章：{chap['title']}\n\n{chap['content']}\n\n" + "-"*50 + "\n\n")
-        f.write(f"第{len(chapters)+1}章：再次声明\n\n" + DISCLAIMER + "\n\n" + "="*50 + "\n")
-    print(f"{Colors.wrap('TXT生成成功', Colors.GREEN)}：{output_path}")
+async def download_chapter_batch(session: aiohttp.ClientSession, item_ids: List[str]) -> Dict[str, Optional[str]]:
+    results = {item_id: None for item_id in item_ids}
+    pending = []
+    for item_id in item_ids:
+        row = cache.execute("SELECT content FROM chapters WHERE item_id=?", (item_id,)).fetchone()
+        if row:
+            results[item_id] = row[0]
+        else:
+            pending.append(item_id)
+    if not pending:
+        return results
+
+    url = "https://toma.jam.cz.eu.org.cdn.cloudflare.net/down/"
+    params = {"item_ids": ",".join(pending), "novelsdk_aid": "638505", "sdk_type": "4"}
+    try:
+        data = await _post_json(session, url, params, aiohttp.ClientTimeout(total=30))
+        if data.get("code") == 0 and isinstance(data.get("data"), list):
+            for entry in data["data"]:
+                if entry.get("item_id") in results and entry.get("content"):
+                    results[entry["item_id"]] = _store_chapter(entry["item_id"], entry["content"])
+    except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError):
+        pass
 
-def build_epub(metadata: Dict, chapters: List[Dict], output_path: str):
-    book = epub.EpubBook()
-    book.set_title(metadata["book_name"])
-    book.add_author(metadata["author"])
-    book.set_language("zh-CN")
-    book.add_metadata('DC', 'description', metadata["summary"])
+    # 接口不支持批量（或部分章节缺失）时退回单章下载
+    for item_id in pending:
+        if results[item_id] is None:
+            results[item_id] = await download_chapter(session, item_id)
+    return results
 
-    if config["save_cover"] and metadata["cover_url"]:
+def build_txt(metadata: Dict, chapters: List[Dict], output_path: str):
+    parts = ["第0章：声明\n\n" + DISCLAIMER + "\n\n" + "-"*50 + "\n\n"]
+    parts.append(f"《{metadata['book_name']}》\n作者：{metadata['author']}\n类型：{metadata['category']} | 状态：{metadata['status']}\n\n简介：{metadata['summary']}\n\n" + "="*50 + "\n\n")
+    parts.extend(f"第{i+1}章：{chap['title']}\n\n{chap['content']}\n\n" + "-"*50 + "\n\n" for i, chap in enumerate(chapters))
+    parts.append(f"第{len(chapters)+1}章：再次声明\n\n" + DISCLAIMER + "\n\n" + "="*50 + "\n")
+    if hasattr(os, 'writev'):
+        # 批量提交所有块，避免逐章的小 write 系统调用
+        bufs = [part.encode('utf-8') for part in parts]
+        fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
         try:
-            resp = session.get(metadata["cover_url"], timeout=10)
-            if resp.status_code == 200:
-                book.set_cover("cover.jpg", resp.content)
-        except:
-            pass
-
-    epub_chapters = []
-    spine = ["nav"]
-
-    disclaim_start = epub.EpubHtml(title="声明", file_name="disclaim_start.xhtml", lang="zh-CN")
-    disclaim_start.content = f"<h1>声明</h1><p>{DISCLAIMER}</p>"
-    book.add_item(disclaim_start)
-    epub_chapters.append(disclaim_start)
-    spine.append(disclaim_start)
-
-    intro = epub.EpubHtml(title="Text信息", file_name="intro.xhtml", lang="zh-CN")
-    intro.content = "<h1>《{}》</h1><p><strong>作者：</strong>{}</p><p><strong>类型：</strong>{} | <strong>状态：</strong>{}</p><p><strong>简介：</strong>{}</p>".format(
-    metadata['book_name'],
-    metadata['author'],
-    metadata['category'],
-    metadata['status'],
-    metadata['summary'].replace('\n', '<br/>')
-)
-    book.add_item(intro)
-    epub_chapters.append(intro)
-    spine.append(intro)
-
-    for i, chap in enumerate(chapters):
-        if not chap["content"]:
-            continue
-        c = epub.EpubHtml(title=f"第{i+1}章：{chap['title']}", file_name=f"chap_{i+1}.xhtml", lang="zh-CN")
-        c.content = "<h2>第{}章：{}</h2><p>{}</p>".format(
-    i + 1,
-    chap['title'],
-    chap['content'].replace('\n', '<br/>')
+            for i in range(0, len(bufs), _IOV_MAX):
+                chunk = bufs[i:i + _IOV_MAX]
+                written = os.writev(fd, chunk)
+                remainder = b''.join(chunk)[written:]
+                if remainder:
+                    os.write(fd, remainder)
+        finally:
+            os.close(fd)
+    else:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(parts))
+    print(f"{Colors.wrap('TXT生成成功', Colors.GREEN)}：{output_path}")
+
+_CHAPTER_PAGE_TPL = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh-CN" xml:lang="zh-CN">'
+    '<head><title>第%d章：%s</title></head>'
+    '<body><h2>第%d章：%s</h2><p>%s</p></body></html>'
 )
-        book.add_item(c)
-        epub_chapters.append(c)
-        spine.append(c)
-
-    disclaim_end = epub.EpubHtml(title="再次声明", file_name="disclaim_end.xhtml", lang="zh-CN")
-    disclaim_end.content = f"<h1>再次声明</h1><p>{DISCLAIMER}</p>"
-    book.add_item(disclaim_end)
-    epub_chapters.append(disclaim_end)
-    spine.append(disclaim_end)
-
-    book.toc = tuple(epub_chapters)
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    book.spine = spine
-    epub.write_epub(output_path, book, {})
+
+def _xhtml_page(title: str, body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh-CN" xml:lang="zh-CN">'
+        f'<head><title>{html.escape(title)}</title></head><body>{body}</body></html>'
+    )
+
+def build_epub(metadata: Dict, chapters: List[Dict], output_path: str, cover_bytes: Optional[bytes] = None):
+    included = [i for i, chap in enumerate(chapters) if chap["content"]]
+    entries = [("disclaim_start.xhtml", "声明"), ("intro.xhtml", "Text信息")]
+    entries += [(f"chap_{i+1}.xhtml", f"第{i+1}章：{chapters[i]['title']}") for i in included]
+    entries.append(("disclaim_end.xhtml", "再次声明"))
+
+    manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+    if cover_bytes:
+        manifest.append('<item id="cover-img" href="cover.jpg" media-type="image/jpeg" properties="cover-image"/>')
+    manifest += [f'<item id="page_{n}" href="{fname}" media-type="application/xhtml+xml"/>' for n, (fname, _) in enumerate(entries)]
+    spine = ['<itemref idref="nav"/>'] + [f'<itemref idref="page_{n}"/>' for n in range(len(entries))]
+
+    opf = (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="uid">urn:uuid:{uuid.uuid4()}</dc:identifier>'
+        f'<dc:title>{html.escape(metadata["book_name"])}</dc:title>'
+        f'<dc:creator>{html.escape(metadata["author"])}</dc:creator>'
+        '<dc:language>zh-CN</dc:language>'
+        f'<dc:description>{html.escape(metadata["summary"])}</dc:description>'
+        f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>'
+        '</metadata>'
+        f'<manifest>{"".join(manifest)}</manifest>'
+        f'<spine>{"".join(spine)}</spine></package>'
+    )
+
+    nav_items = ''.join(f'<li><a href="{fname}">{html.escape(title)}</a></li>' for fname, title in entries)
+    nav = _xhtml_page("目录", f'<nav epub:type="toc"><h1>目录</h1><ol>{nav_items}</ol></nav>')
+
+    intro_body = "<h1>《{}》</h1><p><strong>作者：</strong>{}</p><p><strong>类型：</strong>{} | <strong>状态：</strong>{}</p><p><strong>简介：</strong>{}</p>".format(
+        html.escape(metadata['book_name']),
+        html.escape(metadata['author']),
+        html.escape(metadata['category']),
+        html.escape(metadata['status']),
+        html.escape(metadata['summary']).replace('\n', '<br/>')
+    )
+
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo("mimetype"), b"application/epub+zip", zipfile.ZIP_STORED)
+        zf.writestr("META-INF/container.xml",
+                    '<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                    '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        zf.writestr("OEBPS/content.opf", opf)
+        zf.writestr("OEBPS/nav.xhtml", nav)
+        if cover_bytes:
+            zf.writestr("OEBPS/cover.jpg", cover_bytes)
+        zf.writestr("OEBPS/disclaim_start.xhtml", _xhtml_page("声明", f"<h1>声明</h1><p>{DISCLAIMER}</p>"))
+        zf.writestr("OEBPS/intro.xhtml", _xhtml_page("Text信息", intro_body))
+        for i in included:
+            chap = chapters[i]
+            title = html.escape(chap['title'])
+            text = html.escape(chap['content']).replace('\n', '<br/>')
+            zf.writestr(f"OEBPS/chap_{i+1}.xhtml", _CHAPTER_PAGE_TPL % (i + 1, title, i + 1, title, text))
+        zf.writestr("OEBPS/disclaim_end.xhtml", _xhtml_page("再次声明", f"<h1>再次声明</h1><p>{DISCLAIMER}</p>"))
     print(f"{Colors.wrap('EPUB生成成功', Colors.GREEN)}：{output_path}")
 
-def download_novel(book_id: str):
+async def download_novel(book_id: str):
     print(f"\n{Colors.wrap('===== Text信息 =====', Colors.BLUE)}")
     metadata = get_book_metadata(book_id)
     print(f"书名：{Colors.wrap(metadata['book_name'], Colors.PURPLE)}")
@@ -225,25 +353,37 @@ def download_novel(book_id: str):
     total_chapters = len(chapters)
     print(f"\n{Colors.wrap(f'发现 {total_chapters} 个章节，开始下载...', Colors.GREEN)}")
 
-    chap_contents = []
-    with ThreadPoolExecutor(max_workers=config["default_threads"]) as executor:
-        futures = {executor.submit(download_chapter, chap["item_id"]): i for i, chap in enumerate(chapters)}
-        for future in tqdm(as_completed(futures), total=total_chapters, desc="下载进度"):
-            idx = futures[future]
-            try:
-                content = future.result()
-                chap_contents.append({"title": chapters[idx]["title"], "content": content or f"【章节 {idx+1} 下载失败】"})
-            except Exception as e:
-                chap_contents.append({"title": chapters[idx]["title"], "content": f"【章节 {idx+1} 下载失败：{str(e)}】"})
+    chap_contents = [None] * total_chapters
+    semaphore = asyncio.Semaphore(config["default_threads"] * 8)
+
+    async def fetch_batch(idxs: List[int]):
+        async with semaphore:
+            return idxs, await download_chapter_batch(http, [chapters[i]["item_id"] for i in idxs])
+
+    connector = aiohttp.TCPConnector(limit=64, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, headers=dict(session.headers)) as http:
+        cover_task = None
+        if config["default_format"] == "epub" and config["save_cover"] and metadata["cover_url"]:
+            cover_task = asyncio.ensure_future(_fetch_cover(http, metadata["cover_url"]))
+        tasks = [asyncio.ensure_future(fetch_batch(list(range(i, min(i + BATCH_SIZE, total_chapters)))))
+                 for i in range(0, total_chapters, BATCH_SIZE)]
+        with tqdm(total=total_chapters, desc="下载进度", mininterval=0.5,
+                  miniters=max(1, total_chapters // 200), smoothing=0.05) as progress:
+            for task in asyncio.as_completed(tasks):
+                idxs, batch = await task
+                for idx in idxs:
+                    content = batch[chapters[idx]["item_id"]]
+                    chap_contents[idx] = {"title": chapters[idx]["title"], "content": content or f"【章节 {idx+1} 下载失败】"}
+                progress.update(len(idxs))
+        cover_bytes = await cover_task if cover_task else None
 
-    chap_contents.sort(key=lambda x: chapters.index(next(c for c in chapters if c["title"] == x["title"])))
     fname = f"{sanitize_filename(metadata['book_name'])}-{sanitize_filename(metadata['author'])}"
     if '未知' in fname:
         fname += f"_{book_id}"
     output_path = os.path.join('download', f"{fname}.{config['default_format']}")
 
     if config["default_format"] == "epub":
-        build_epub(metadata, chap_contents, output_path)
+        build_epub(metadata, chap_contents, output_path, cover_bytes)
     else:
         build_txt(metadata, chap_contents, output_path)
 
@@ -270,7 +410,7 @@ def main():
             except:
                 pass
 
-    download_novel(book_id)
+    asyncio.run(download_novel(book_id))
 
 if __name__ == "__main__":
     main()